@@ -261,17 +261,14 @@ class NavierStokesSystem():
         _un, _un1 = un[1:-1, 1:-1], un1[1:-1, 1:-1]
         _vn, _vn1 = vn[1:-1, 1:-1], vn1[1:-1, 1:-1]
 
-        _un_dx, _un_dy = self.Dx[1:-1, 1:-1] @ _un, _un @ self.Dy[1:-1, 1:-1].T
-        _un1_dx, _un1_dy = self.Dx[1:-1, 1:-1] @ _un1, _un1 @ self.Dy[1:-1, 1:-1].T
-
-        _vn_dx, _vn_dy = self.Dx[1:-1, 1:-1] @ _vn, _vn @ self.Dy[1:-1, 1:-1].T
-        _vn1_dx, _vn1_dy = self.Dx[1:-1, 1:-1] @ _vn1, _vn1 @ self.Dy[1:-1, 1:-1].T
-
-        _un_ddx, _un_ddy = self.Dx_sqr[1:-1, 1:-1] @ _un, _un @ self.Dy_sqr[1:-1, 1:-1].T
-        _un1_ddx, _un1_ddy = self.Dx_sqr[1:-1, 1:-1] @ _un1, _un1 @ self.Dy_sqr[1:-1, 1:-1].T
-
-        _vn_ddx, _vn_ddy = self.Dx_sqr[1:-1, 1:-1] @ _vn, _vn @ self.Dy_sqr[1:-1, 1:-1].T
-        _vn1_ddx, _vn1_ddy = self.Dx_sqr[1:-1, 1:-1] @ _vn1, _vn1 @ self.Dy_sqr[1:-1, 1:-1].T
+        # all four fields share the same derivative matrices, so batch
+        # them into a (4, N-2, N-2) stack and take each derivative with
+        # one broadcasted matmul instead of four separate ones
+        fields = np.stack([_un, _un1, _vn, _vn1])
+        _un_dx, _un1_dx, _vn_dx, _vn1_dx = self.Dx[1:-1, 1:-1] @ fields
+        _un_dy, _un1_dy, _vn_dy, _vn1_dy = fields @ self.Dy[1:-1, 1:-1].T
+        _un_ddx, _un1_ddx, _vn_ddx, _vn1_ddx = self.Dx_sqr[1:-1, 1:-1] @ fields
+        _un_ddy, _un1_ddy, _vn_ddy, _vn1_ddy = fields @ self.Dy_sqr[1:-1, 1:-1].T
 
         # u_F and v_F are both N-2 x N-2 matrices
         u_F = 2 * _un - 3 * self.dt * (_un * _un_dx + _vn * _un_dy) + \
@@ -410,13 +407,12 @@ class NavierStokesSystem():
         where \mathcal{U} = [u(x_0), ..., u(x_N)], the values of the
         function at the coordinate points.
         """
-        T = [
-            self._get_gauss_lobatto_points(N, k=k)
-            for k in np.arange(0, N)
-        ]
+        k = np.arange(0, N)[:, np.newaxis]
+        i = np.arange(0, N)[np.newaxis, :]
         # N(k) x N(i) since this will be multiplied by the matrix
-        # of spectral coefficients (k)
-        return np.stack(T)
+        # of spectral coefficients (k); one cosine over the outer
+        # product rather than N separate row builds
+        return np.cos(k * np.pi * i / float(N - 1))
 
     def _get_inv_T_matrix(self, N):
         """
@@ -426,14 +422,15 @@ class NavierStokesSystem():
         where \hat{\mathcal{U}} = [\hat{u}_0, ..., \hat{u}_N], the
         coefficients of the truncated spectral approximation.
         """
-        inv_T = np.stack([  self._get_gauss_lobatto_points(N, k=k)
-                            for k in np.arange(0, N)  ])
-        inv_T = inv_T.T  # size N(i) x N(k)
-
-        # bar_c_i is size N(i) x N(k)
-        bar_c_i = np.stack([np.repeat(self._get_bar_c_k(i, N), N)
-                            for i in np.arange(0, N)])
-        bar_c_k = bar_c_i.T
+        i = np.arange(0, N)[:, np.newaxis]
+        k = np.arange(0, N)[np.newaxis, :]
+        inv_T = np.cos(i * np.pi * k / float(N - 1))  # size N(i) x N(k)
+
+        # bar_c_i broadcasts down rows, bar_c_k across columns
+        idx = np.arange(0, N)
+        bar_c = np.where((idx == 0) | (idx == N), 2, 1)
+        bar_c_i = bar_c[:, np.newaxis]
+        bar_c_k = bar_c[np.newaxis, :]
 
         inv_T = 2 * inv_T / (bar_c_k * bar_c_i * N)
         # N(i) x N(k) since this will be multiplied by the matrix
@@ -1,18 +1,179 @@
 """
 Simulator for Two-Dimensional Incompressible Navier Stokes
-using Direct Finite Difference Discretization. This means 
+using Direct Finite Difference Discretization. This means
 we must iteratively estimate pressure and impose somewhat
-superficial boundary conditions on pressure. 
+superficial boundary conditions on pressure.
 """
 
 import numpy as np
+from numba import njit, prange
 from tqdm import tqdm
 
+# edge length of the cache blocks used in the pressure sweeps
+_TILE = 64
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _build_up_b_kernel(b, u, v, rho, dt, dx, dy):
+    """
+    Scalar-loop version of the RHS of the pressure Poisson eqn.
+    Fusing the sliced NumPy expression into one loop avoids a
+    temporary array per subexpression.
+    """
+    nx, ny = b.shape
+    # loop invariants: divisions become multiplications by reciprocals
+    inv_2dx = 1.0 / (2 * dx)
+    inv_2dy = 1.0 / (2 * dy)
+    rho_inv_dt = rho / dt
+    for i in prange(1, nx - 1):
+        for j in range(1, ny - 1):
+            du_dx = (u[i, j+1] - u[i, j-1]) * inv_2dx
+            du_dy = (u[i+1, j] - u[i-1, j]) * inv_2dy
+            dv_dx = (v[i, j+1] - v[i, j-1]) * inv_2dx
+            dv_dy = (v[i+1, j] - v[i-1, j]) * inv_2dy
+            b[i, j] = (rho_inv_dt * (du_dx + dv_dy) -
+                       du_dx**2 - 2 * (du_dy * dv_dx) - dv_dy**2)
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _pressure_rb_sweep_kernel(p, b, color, dx, dy,
+                              neu_x_lo, neu_x_hi, neu_y_lo, neu_y_hi):
+    """
+    Half of a red-black Gauss-Seidel sweep of the pressure Poisson eqn.
+
+    Points with (i + j) % 2 == color are updated in place using the
+    current values of their (opposite-color) neighbors, so no second
+    pressure buffer is needed and convergence is roughly twice as
+    fast as the Jacobi iteration this replaces.
+
+    The neu_* flags mark sides whose boundary values are slaved to the
+    interior by a zero-gradient (Neumann) condition. At points next to
+    such a side the boundary neighbor equals the center, so its term
+    is dropped and its weight folded into the diagonal (a reflected
+    stencil); relaxing those points with the plain stencil leaves the
+    boundary-adjacent error untouched and stalls the V-cycle.
+
+    The traversal is blocked into _TILE x _TILE tiles so the stencil
+    neighborhood of a tile stays resident in L1 on grids whose rows
+    no longer fit in cache.
+    """
+    nx, ny = p.shape
+    dx2, dy2 = dx * dx, dy * dy
+    dx2dy2 = dx2 * dy2
+    diag = 2 * (dx2 + dy2)
+    inv_diag = 1.0 / diag
+    # prange only supports unit steps, so iterate tile indices
+    n_tiles_i = (nx - 3) // _TILE + 1
+    for ti in prange(n_tiles_i):
+        ii = 1 + ti * _TILE
+        for jj in range(1, ny - 1, _TILE):
+            for i in range(ii, min(ii + _TILE, nx - 1)):
+                for j in range(jj + (i + jj + color) % 2,
+                               min(jj + _TILE, ny - 1), 2):
+                    num = ((p[i, j+1] + p[i, j-1]) * dy2 +
+                           (p[i+1, j] + p[i-1, j]) * dx2 -
+                           dx2dy2 * b[i, j])
+                    d = diag
+                    if neu_x_lo and i == 1:
+                        num -= p[0, j] * dx2
+                        d -= dx2
+                    if neu_x_hi and i == nx - 2:
+                        num -= p[nx-1, j] * dx2
+                        d -= dx2
+                    if neu_y_lo and j == 1:
+                        num -= p[i, 0] * dy2
+                        d -= dy2
+                    if neu_y_hi and j == ny - 2:
+                        num -= p[i, ny-1] * dy2
+                        d -= dy2
+                    if d == diag:
+                        p[i, j] = num * inv_diag
+                    else:
+                        p[i, j] = num / d
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _residual_kernel(r, p, b, dx, dy):
+    """Residual r = b - laplace(p) of the discrete Poisson eqn."""
+    nx, ny = r.shape
+    inv_dx2 = 1.0 / (dx * dx)
+    inv_dy2 = 1.0 / (dy * dy)
+    for i in prange(1, nx - 1):
+        for j in range(1, ny - 1):
+            r[i, j] = (b[i, j] -
+                       (p[i, j+1] - 2 * p[i, j] + p[i, j-1]) * inv_dx2 -
+                       (p[i+1, j] - 2 * p[i, j] + p[i-1, j]) * inv_dy2)
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _restrict_kernel(r_fine, r_coarse):
+    """Full-weighting restriction: (4*center + 2*edges + corners) / 16."""
+    nxc, nyc = r_coarse.shape
+    for i in prange(1, nxc - 1):
+        for j in range(1, nyc - 1):
+            fi, fj = 2 * i, 2 * j
+            r_coarse[i, j] = (4 * r_fine[fi, fj] +
+                              2 * (r_fine[fi+1, fj] + r_fine[fi-1, fj] +
+                                   r_fine[fi, fj+1] + r_fine[fi, fj-1]) +
+                              r_fine[fi+1, fj+1] + r_fine[fi+1, fj-1] +
+                              r_fine[fi-1, fj+1] + r_fine[fi-1, fj-1]) / 16.
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _prolong_add_kernel(e_coarse, p_fine):
+    """Bilinear prolongation of the coarse-grid correction, added in place."""
+    nxf, nyf = p_fine.shape
+    for i in prange(1, nxf - 1):
+        for j in range(1, nyf - 1):
+            ci, cj = i // 2, j // 2
+            if i % 2 == 0 and j % 2 == 0:
+                e = e_coarse[ci, cj]
+            elif i % 2 == 1 and j % 2 == 0:
+                e = 0.5 * (e_coarse[ci, cj] + e_coarse[ci+1, cj])
+            elif i % 2 == 0 and j % 2 == 1:
+                e = 0.5 * (e_coarse[ci, cj] + e_coarse[ci, cj+1])
+            else:
+                e = 0.25 * (e_coarse[ci, cj] + e_coarse[ci+1, cj] +
+                            e_coarse[ci, cj+1] + e_coarse[ci+1, cj+1])
+            p_fine[i, j] += e
+
+
+@njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+def _velocity_kernel(u, v, un, vn, p, rho, nu, dt, dx, dy):
+    """Fused u/v momentum update: read un/vn/p, write u/v."""
+    nx, ny = u.shape
+    # loop invariants, computed once per call
+    dt_dx = dt / dx
+    dt_dy = dt / dy
+    dt_2rho_dx = dt / (2 * rho * dx)
+    dt_2rho_dy = dt / (2 * rho * dy)
+    nu_dt_dx2 = nu * dt / dx**2
+    nu_dt_dy2 = nu * dt / dy**2
+    for i in prange(1, nx - 1):
+        for j in range(1, ny - 1):
+            u[i, j] = (un[i, j] -
+                       un[i, j] * dt_dx * (un[i, j] - un[i, j-1]) -
+                       vn[i, j] * dt_dy * (un[i, j] - un[i-1, j]) -
+                       dt_2rho_dx * (p[i, j+1] - p[i, j-1]) +
+                       nu_dt_dx2 *
+                      (un[i, j+1] - 2 * un[i, j] + un[i, j-1]) +
+                       nu_dt_dy2 *
+                      (un[i+1, j] - 2 * un[i, j] + un[i-1, j]))
+
+            v[i, j] = (vn[i, j] -
+                       un[i, j] * dt_dx * (vn[i, j] - vn[i, j-1]) -
+                       vn[i, j] * dt_dy * (vn[i, j] - vn[i-1, j]) -
+                       dt_2rho_dy * (p[i+1, j] - p[i-1, j]) +
+                       nu_dt_dx2 *
+                      (vn[i, j+1] - 2 * vn[i, j] + vn[i, j-1]) +
+                       nu_dt_dy2 *
+                      (vn[i+1, j] - 2 * vn[i, j] + vn[i-1, j]))
+
 
 class NavierStokesSystem():
     """
     Wrapper class around a 2D Incompressible Navier Stokes system.
-    
+
     Args:
     -----
     u_ic : np.array
@@ -30,7 +191,7 @@ class NavierStokesSystem():
     nt : integer
          number of time steps to run
     nit : integer
-          number of internal iterations for convergence in pressure estimate
+          maximum number of V-cycles for convergence in pressure estimate
     nx : integer
          number of grid points across x
     ny : integer
@@ -41,61 +202,171 @@ class NavierStokesSystem():
           constant in the Navier Stokes equations
     nu : float
          constant in the Navier Stokes equations
+    tol : float
+          residual tolerance to stop the pressure V-cycles early
+    dtype : np.dtype (default: np.float32)
+            precision of the solver; the solve is memory-bound so
+            float32 halves bandwidth and is plenty accurate here
+    use_gpu : boolean (default: False)
+              run the stencils as cupy elementwise kernels on the GPU;
+              worthwhile once grids grow past a few hundred points per
+              side where the CPU becomes bandwidth-bound
     """
 
-    def __init__(self, u_ic, v_ic, p_ic, u_bc, v_bc, p_bc, 
-                 nt=200, nit=50, nx=50, ny=50, dt=0.001, rho=1, nu=0.1):
+    def __init__(self, u_ic, v_ic, p_ic, u_bc, v_bc, p_bc,
+                 nt=200, nit=50, nx=50, ny=50, dt=0.001, rho=1, nu=0.1,
+                 tol=1e-3, dtype=np.float32, use_gpu=False):
         super().__init__()
-        self.u_ic, self.v_ic, self.p_ic = u_ic, v_ic, p_ic
+        self.use_gpu = use_gpu
+        if use_gpu:
+            import cupy
+            self.xp = cupy
+        else:
+            self.xp = np
+        self.dtype = np.dtype(dtype).type
+        self.u_ic = self.xp.asarray(u_ic.astype(dtype))
+        self.v_ic = self.xp.asarray(v_ic.astype(dtype))
+        self.p_ic = self.xp.asarray(p_ic.astype(dtype))
         self.u_bc, self.v_bc, self.p_bc = u_bc, v_bc, p_bc
-        self.nt, self.dt, self.nx, self.ny = nt, dt, nx, ny
+        self.nt, self.nx, self.ny = nt, nx, ny
+        # scalars carry the solver dtype so the jitted kernels stay
+        # in single precision when dtype is float32
+        self.dt = self.dtype(dt)
         # hard code to size of x over 2 (un-dimensionalize to [-1, 1])
-        self.dx, self.dy = 2. / (self.nx - 1), 2. / (self.ny - 1)
-        self.nit, self.rho, self.nu = nit, rho, nu
-
-    def _build_up_b(self, u, v):
-        rho, dt, dx, dy = self.rho, self.dt, self.dx, self.dy
-        b = np.zeros_like(u)
-        b[1:-1, 1:-1] = (rho * (1 / dt * 
-                        ((u[1:-1, 2:] - u[1:-1, 0:-2]) / (2 * dx) + 
+        self.dx = self.dtype(2. / (self.nx - 1))
+        self.dy = self.dtype(2. / (self.ny - 1))
+        self.rho, self.nu = self.dtype(rho), self.dtype(nu)
+        self.nit, self.tol = nit, tol
+        # persistent scratch buffers for the pressure solve so the
+        # Poisson RHS and residual are not reallocated every time step
+        self._b = self.xp.zeros_like(self.p_ic)
+        self._r = self.xp.zeros_like(self.p_ic)
+        # the coarse levels of the V-cycle solve the *error* equation,
+        # whose boundary conditions are the homogenized pressure BCs:
+        # zero on Dirichlet sides, zero-gradient on Neumann sides
+        self._p_bc0 = [type(bc)(0, bc.boundary, float(self.dx), float(self.dy))
+                       for bc in p_bc]
+        # sides where pressure is slaved Neumann; the sweep kernel
+        # folds these into a reflected stencil at the adjacent points
+        neu = set(bc.boundary for bc in p_bc if bc.type == 'neumann')
+        self._p_neu = ('left' in neu, 'right' in neu,
+                       'bottom' in neu, 'top' in neu)
+        # per-level multigrid scratch (residual, restricted residual,
+        # coarse error), keyed by fine-grid shape and allocated once
+        self._mg_scratch = {}
+        # previous-step velocity buffers, reused across steps
+        self._un = self.xp.zeros_like(self.u_ic)
+        self._vn = self.xp.zeros_like(self.v_ic)
+
+    def _smooth(self, p, b, bcs, dx, dy, n_iter=2):
+        neu_x_lo, neu_x_hi, neu_y_lo, neu_y_hi = self._p_neu
+        for _ in range(n_iter):
+            # red points then black points, each in place; reimpose
+            # the boundary conditions after every sweep so the slaved
+            # edges track the interior
+            _pressure_rb_sweep_kernel(p, b, 0, dx, dy,
+                                      neu_x_lo, neu_x_hi, neu_y_lo, neu_y_hi)
+            _pressure_rb_sweep_kernel(p, b, 1, dx, dy,
+                                      neu_x_lo, neu_x_hi, neu_y_lo, neu_y_hi)
+            for bc in bcs:
+                p = bc.apply(p)
+
+    def _v_cycle(self, p, b, bcs, dx, dy):
+        """
+        One geometric multigrid V-cycle for laplace(p) = b:
+        smooth, restrict the residual to a grid of half the
+        resolution, recurse on the error equation, prolong the
+        correction back, smooth again. O(N) per cycle versus
+        O(N^1.5) for the fixed smoothing iterations it replaces.
+        """
+        nx, ny = p.shape
+
+        # can only coarsen grids with an odd number of points per side
+        if (nx - 1) % 2 != 0 or (ny - 1) % 2 != 0 or min(nx, ny) < 7:
+            # coarsest level: solve nearly exactly. The grid is tiny,
+            # and Neumann sides leave a near-null mode that a couple of
+            # sweeps cannot resolve, which would cap the whole cycle's
+            # convergence rate
+            self._smooth(p, b, bcs, dx, dy, n_iter=30)
+            return
+
+        self._smooth(p, b, bcs, dx, dy)
+
+        if (nx, ny) not in self._mg_scratch:
+            nxc, nyc = (nx - 1) // 2 + 1, (ny - 1) // 2 + 1
+            self._mg_scratch[(nx, ny)] = (
+                np.zeros_like(p),
+                np.zeros((nxc, nyc), dtype=p.dtype),
+                np.zeros((nxc, nyc), dtype=p.dtype))
+        r, rc, ec = self._mg_scratch[(nx, ny)]
+        _residual_kernel(r, p, b, dx, dy)
+        _restrict_kernel(r, rc)
+
+        # solve the error equation on the coarse grid under the
+        # homogenized boundary conditions (zero initial guess)
+        ec[:] = 0
+        self._v_cycle(ec, rc, self._p_bc0, 2 * dx, 2 * dy)
+
+        _prolong_add_kernel(ec, p)
+        self._smooth(p, b, bcs, dx, dy)
+
+    def _pressure_poisson(self, p, u, v):
+        # build the Poisson RHS right before the first sweep reads it,
+        # so b stays hot in cache instead of making a separate pass
+        b, r = self._b, self._r
+        _build_up_b_kernel(b, u, v, self.rho, self.dt, self.dx, self.dy)
+
+        # the boundary conditions are applied inside the smoother, so
+        # p satisfies them whenever the residual is checked
+        prev = np.inf
+        for q in range(self.nit):
+            self._v_cycle(p, b, self.p_bc, self.dx, self.dy)
+
+            _residual_kernel(r, p, b, self.dx, self.dy)
+            res = np.max(np.abs(r[1:-1, 1:-1]))
+            # stop at tolerance, or once the residual has hit the
+            # precision floor and further cycles make no progress
+            if res < self.tol or res >= prev:
+                break
+            prev = res
+
+        return p
+
+    def _step_xp(self, u, v, p):
+        """
+        GPU path: the same sliced array expressions the solver used
+        before JIT-compilation, executed by cupy as elementwise device
+        kernels. Pressure uses nit Jacobi sweeps here since the
+        multigrid recursion is CPU-resident.
+        """
+        dt, dx, dy = self.dt, self.dx, self.dy
+        rho, nu = self.rho, self.nu
+        un, vn = self._un, self._vn
+        self.xp.copyto(un, u)
+        self.xp.copyto(vn, v)
+
+        b = self._b
+        b[1:-1, 1:-1] = (rho * (1 / dt *
+                        ((u[1:-1, 2:] - u[1:-1, 0:-2]) / (2 * dx) +
                          (v[2:, 1:-1] - v[0:-2, 1:-1]) / (2 * dy))) -
                         ((u[1:-1, 2:] - u[1:-1, 0:-2]) / (2 * dx))**2 -
                         2 * ((u[2:, 1:-1] - u[0:-2, 1:-1]) / (2 * dy) *
                              (v[1:-1, 2:] - v[1:-1, 0:-2]) / (2 * dx)) -
                             ((v[2:, 1:-1] - v[0:-2, 1:-1]) / (2 * dy))**2)
-        return b
-
-    def _pressure_poisson(self, p, b):
-        pn = np.empty_like(p)
-        pn = p.copy()
 
-        dt, dx, dy = self.dt, self.dx, self.dy
-        rho, nu = self.rho, self.nu
-
-        dx, dy = self.dx, self.dy
         for q in range(self.nit):
             pn = p.copy()
-            p[1:-1, 1:-1] = (((pn[1:-1, 2:] + pn[1:-1, 0:-2]) * dy**2 + 
+            p[1:-1, 1:-1] = (((pn[1:-1, 2:] + pn[1:-1, 0:-2]) * dy**2 +
                             (pn[2:, 1:-1] + pn[0:-2, 1:-1]) * dx**2) /
                             (2 * (dx**2 + dy**2)) -
-                            dx**2 * dy**2 / (2 * (dx**2 + dy**2)) * 
-                            b[1:-1,1:-1])
+                            dx**2 * dy**2 / (2 * (dx**2 + dy**2)) *
+                            b[1:-1, 1:-1])
 
             # set boundary conditions for pressure
             for bc in self.p_bc:
                 p = bc.apply(p)
-            
-        return p
 
-    def step(self, u, v, p):
-        un, vn = u.copy(), v.copy()
-        b = self._build_up_b(u, v)
-        p = self._pressure_poisson(p, b)
-
-        dt, dx, dy = self.dt, self.dx, self.dy
-        rho, nu = self.rho, self.nu
-
-        u[1:-1, 1:-1] = (un[1:-1, 1:-1]-
+        u[1:-1, 1:-1] = (un[1:-1, 1:-1] -
                          un[1:-1, 1:-1] * dt / dx *
                         (un[1:-1, 1:-1] - un[1:-1, 0:-2]) -
                          vn[1:-1, 1:-1] * dt / dy *
@@ -105,22 +376,45 @@ class NavierStokesSystem():
                         (un[1:-1, 2:] - 2 * un[1:-1, 1:-1] + un[1:-1, 0:-2]) +
                          dt / dy**2 *
                         (un[2:, 1:-1] - 2 * un[1:-1, 1:-1] + un[0:-2, 1:-1])))
-        
-        v[1:-1,1:-1] = (vn[1:-1, 1:-1] -
-                        un[1:-1, 1:-1] * dt / dx *
-                       (vn[1:-1, 1:-1] - vn[1:-1, 0:-2]) -
-                        vn[1:-1, 1:-1] * dt / dy *
-                       (vn[1:-1, 1:-1] - vn[0:-2, 1:-1]) -
-                        dt / (2 * rho * dy) * (p[2:, 1:-1] - p[0:-2, 1:-1]) +
-                        nu * (dt / dx**2 *
-                       (vn[1:-1, 2:] - 2 * vn[1:-1, 1:-1] + vn[1:-1, 0:-2]) +
-                        dt / dy**2 *
-                       (vn[2:, 1:-1] - 2 * vn[1:-1, 1:-1] + vn[0:-2, 1:-1])))
+
+        v[1:-1, 1:-1] = (vn[1:-1, 1:-1] -
+                         un[1:-1, 1:-1] * dt / dx *
+                        (vn[1:-1, 1:-1] - vn[1:-1, 0:-2]) -
+                         vn[1:-1, 1:-1] * dt / dy *
+                        (vn[1:-1, 1:-1] - vn[0:-2, 1:-1]) -
+                         dt / (2 * rho * dy) * (p[2:, 1:-1] - p[0:-2, 1:-1]) +
+                         nu * (dt / dx**2 *
+                        (vn[1:-1, 2:] - 2 * vn[1:-1, 1:-1] + vn[1:-1, 0:-2]) +
+                         dt / dy**2 *
+                        (vn[2:, 1:-1] - 2 * vn[1:-1, 1:-1] + vn[0:-2, 1:-1])))
+
+        # set boundary conditions
+        for bc in self.u_bc:
+            u = bc.apply(u)
+
+        for bc in self.v_bc:
+            v = bc.apply(v)
+
+        return u, v, p
+
+    def step(self, u, v, p):
+        if self.use_gpu:
+            return self._step_xp(u, v, p)
+
+        # np.copyto reuses the preallocated buffers instead of
+        # allocating fresh copies every step
+        un, vn = self._un, self._vn
+        np.copyto(un, u)
+        np.copyto(vn, v)
+        p = self._pressure_poisson(p, u, v)
+
+        _velocity_kernel(u, v, un, vn, p, self.rho, self.nu,
+                         self.dt, self.dx, self.dy)
 
         # set boundary conditions
         for bc in self.u_bc:
             u = bc.apply(u)
-        
+
         for bc in self.v_bc:
             v = bc.apply(v)
 
@@ -130,13 +424,19 @@ class NavierStokesSystem():
         # collect propagations for dataset
         u_list, v_list, p_list = [], [], []
         u, v, p = self.u_ic, self.v_ic, self.p_ic
-    
+
         for n in tqdm(range(self.nt)):
             u, v, p = self.step(u, v, p)
-            u_list.append(u.copy())
-            v_list.append(v.copy())
-            p_list.append(p.copy())
-    
+            if self.use_gpu:
+                # bring each snapshot back to host memory
+                u_list.append(self.xp.asnumpy(u))
+                v_list.append(self.xp.asnumpy(v))
+                p_list.append(self.xp.asnumpy(p))
+            else:
+                u_list.append(u.copy())
+                v_list.append(v.copy())
+                p_list.append(p.copy())
+
         u_list = np.stack(u_list)
         v_list = np.stack(v_list)
         p_list = np.stack(p_list)
@@ -145,13 +445,15 @@ class NavierStokesSystem():
 
 
 if __name__ == "__main__":
-    from src.boundary import (DirichletBoundaryCondition, 
+    from src.boundary import (DirichletBoundaryCondition,
                               NeumannBoundaryCondition)
 
     nt  = 200
     nit = 50
-    nx  = 50
-    ny  = 50
+    # 2^k + 1 points per side so the multigrid pressure solve can
+    # coarsen (65 -> 33 -> 17 -> 9); even sizes fall back to smoothing
+    nx  = 65
+    ny  = 65
     dt  = 0.001
     rho = 1
     nu  = 0.1
@@ -185,11 +487,10 @@ if __name__ == "__main__":
     ]
 
     system = NavierStokesSystem(
-        u_ic, v_ic, p_ic, u_bc, v_bc, p_bc, 
-        nt=nt, nit=nit, nx=nx, ny=ny, dt=dt, 
+        u_ic, v_ic, p_ic, u_bc, v_bc, p_bc,
+        nt=nt, nit=nit, nx=nx, ny=ny, dt=dt,
         rho=rho, nu=nu,
     )
 
     u_data, v_data, p_data = system.simulate()
     np.savez('./data.npz', u=u_data, v=v_data, p=p_data)
-
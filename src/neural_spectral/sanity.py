@@ -13,24 +13,29 @@ def get_bar_c_k(k, K):
 
 
 def get_T_matrix(N, K):
-    T = np.stack( [ get_gauss_lobatto_points(N, k=k)
-                    for k in np.arange(K) ] ).T
+    # cosine over the outer product instead of K separate row builds
+    i = np.arange(N)[:, np.newaxis]
+    k = np.arange(K)[np.newaxis, :]
+    T = np.cos(k * np.pi * i / float(N - 1))
     return T
 
 
 def get_inv_T_matrix(N, K):
-    inv_T = np.stack([np.cos(np.pi * np.arange(N) / float(N - 1))
-                      for k in np.arange(K)])
-    bar_c_i = np.array([get_bar_c_k(i, N) for i in range(N)])[np.newaxis, :]
-    bar_c_k = np.array([get_bar_c_k(k, K) for k in range(K)])[:, np.newaxis]
+    i = np.arange(N)
+    k = np.arange(K)
+    inv_T = np.broadcast_to(np.cos(np.pi * i / float(N - 1)), (K, N))
+    bar_c_i = np.where((i == 0) | (i == N), 2, 1)[np.newaxis, :]
+    bar_c_k = np.where((k == 0) | (k == K), 2, 1)[:, np.newaxis]
 
     inv_T = 2 * inv_T / (bar_c_k * bar_c_i * N)
     return inv_T
 
 
 data = np.load('../data/data_semi_implicit.npz')
-Us = data['u']
-nt, nx, ny = Us.shape[0], Us.shape[1], Us.shape[2]
+# only the first frame is checked, so slice at the source instead
+# of materializing the whole sequence
+U = data['u'][0]
+nx, ny = U.shape[0], U.shape[1]
 n_coeff = 51
 
 Tx = get_T_matrix(nx, n_coeff)    # k x N
@@ -38,10 +43,7 @@ Ty = get_T_matrix(ny, n_coeff).T  # N x k
 T = Tx @ Ty  # k x k
 T_inv = np.linalg.inv(T)
 
-for t in range(nt): 
-    U = Us[t]
-    U_hat = T_inv @ U
-    U_recon = T @ U_hat
-    print(np.linalg.norm(U - U_recon))
-    break
+U_hat = T_inv @ U
+U_recon = T @ U_hat
+print(np.linalg.norm(U - U_recon))
 